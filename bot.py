@@ -3,23 +3,34 @@
 LivePlace Telegram Bot — версия с постоянным хранением статистики и анимированными лайками
 """
 
+import gc
 import os
 import re
+import sys
 import json
 import time
 import random
 import asyncio
+import heapq
 import logging
 import sqlite3
 from time import monotonic
+from hashlib import blake2b
+from functools import lru_cache
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
-from collections import Counter, defaultdict
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Tuple, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from collections import ChainMap, Counter, defaultdict
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse, quote_plus
 from contextlib import contextmanager
+from types import SimpleNamespace
+
+import numpy as np
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
@@ -30,11 +41,44 @@ from aiogram.types import (
 
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import LRUCache, TTLCache
+from aiolimiter import AsyncLimiter
 
 # ------ Logging ------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("liveplace")
 
+# ------ Optional speedups ------
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumps = lambda o: orjson.dumps(o).decode()
+else:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from aiogram.fsm.storage.redis import RedisStorage
+except ImportError:
+    RedisStorage = None
+
 # ------ Load .env ------
 try:
     from dotenv import load_dotenv
@@ -51,15 +95,34 @@ class Config:
     GSHEET_ID = os.getenv("GSHEET_ID", "1yrB5Vy7o18B05nkJBqQe9hE9971jJsTMEKKTsDHGa8w").strip()
     GSHEET_TAB = os.getenv("GSHEET_TAB", "Ads").strip()
     GSHEET_REFRESH_SEC = int(os.getenv("GSHEET_REFRESH_SEC", "120") or "120")
+    GSHEET_HARD_TTL_SEC = int(os.getenv("GSHEET_HARD_TTL_SEC", "900") or "900")
+    GSHEET_CHECK_MODIFIED = os.getenv("GSHEET_CHECK_MODIFIED", "1").strip() not in {"0", "false", "False", ""}
     ADS_ENABLED = os.getenv("ADS_ENABLED", "1").strip() not in {"0", "false", "False", ""}
     ADS_PROB = float(os.getenv("ADS_PROB", "0.18") or 0.18)
     ADS_COOLDOWN_SEC = int(os.getenv("ADS_COOLDOWN_SEC", "180") or 180)
     UTM_SOURCE = os.getenv("UTM_SOURCE", "telegram")
     UTM_MEDIUM = os.getenv("UTM_MEDIUM", "bot")
     UTM_CAMPAIGN = os.getenv("UTM_CAMPAIGN", "bot_ads")
+    UTM_SECRET = os.getenv("UTM_SECRET", "")
     MEDIA_RETRY_COUNT = 3
     MEDIA_RETRY_DELAY = 2
+    PHOTO_FILE_ID_CACHE = int(os.getenv("PHOTO_FILE_ID_CACHE", "10000") or 10000)
+    LEAD_BREAKER_FAILS = int(os.getenv("LEAD_BREAKER_FAILS", "5") or 5)
+    LEAD_BREAKER_COOLDOWN_SEC = int(os.getenv("LEAD_BREAKER_COOLDOWN_SEC", "300") or 300)
     DB_PATH = os.getenv("DB_PATH", "liveplace_stats.db")
+    # Снимок таблицы для быстрого старта (там и телефоны владельцев) — только если путь задан явно
+    CACHE_SNAPSHOT_PATH = os.getenv("CACHE_SNAPSHOT_PATH", "")
+    ACTIONS_RETENTION_DAYS = int(os.getenv("ACTIONS_RETENTION_DAYS", "0") or 0)
+    HEARTBEAT_SEC = int(os.getenv("HEARTBEAT_SEC", "600") or 600)
+    GC_RSS_MB = int(os.getenv("GC_RSS_MB", "512") or 0)
+    USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "100000") or 100000)
+    USER_TTL_SEC = int(os.getenv("USER_TTL_SEC", "3600") or 3600)
+    LEAD_TTL_SEC = int(os.getenv("LEAD_TTL_SEC", "600") or 600)
+    SEND_RATE_PER_SEC = int(os.getenv("SEND_RATE_PER_SEC", "30") or 30)
+    SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4") or 4)
+    REDIS_URL = os.getenv("REDIS_URL", "").strip()
+    FSM_TTL_SEC = int(os.getenv("FSM_TTL_SEC", "3600") or 3600)
+    POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "20") or 20)
     
     # Стикеры с сердечками для анимации лайков (можно заменить на свои)
     HEART_STICKERS = [
@@ -70,10 +133,56 @@ if not Config.API_TOKEN:
     raise RuntimeError("API_TOKEN is not set")
 
 # ------ Bot & Dispatcher ------
-bot = Bot(token=Config.API_TOKEN, parse_mode="HTML")
-dp = Dispatcher(storage=MemoryStorage())
+if orjson is not None:
+    session = AiohttpSession(json_loads=json_loads, json_dumps=json_dumps)
+else:
+    session = AiohttpSession()
+bot = Bot(token=Config.API_TOKEN, parse_mode="HTML", session=session)
+def make_fsm_storage():
+    """Анкета поиска в Redis (переживает рестарт, брошенные истекают по TTL), иначе в памяти процесса"""
+    if Config.REDIS_URL:
+        if RedisStorage is not None:
+            return RedisStorage.from_url(
+                Config.REDIS_URL, state_ttl=Config.FSM_TTL_SEC, data_ttl=Config.FSM_TTL_SEC,
+                json_loads=json_loads, json_dumps=json_dumps,
+            )
+        logger.warning("⚠️ REDIS_URL is set but redis is not installed, using MemoryStorage")
+    return MemoryStorage()
+
+dp = Dispatcher(storage=make_fsm_storage())
+
+# ------ Outgoing queue ------
+# Фоновые уведомления (заявки, сообщения админу) идут через очередь и общий
+# лимит Telegram (~30 сообщений/сек), чтобы всплеск не занимал весь лимит бота
+_SEND_Q: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+_RATE_LIMITER = AsyncLimiter(Config.SEND_RATE_PER_SEC, 1)
+
+async def queue_message(chat_id: int, text: str, **kwargs):
+    await _SEND_Q.put({"chat_id": chat_id, "text": text, **kwargs})
+
+async def send_worker():
+    while True:
+        item = await _SEND_Q.get()
+        try:
+            while True:
+                try:
+                    async with _RATE_LIMITER:
+                        await bot.send_message(**item)
+                    break
+                except TelegramRetryAfter as e:
+                    # Telegram сам говорит, сколько ждать; воркер стоит — очередь копится, но порядок сохраняется
+                    logger.warning(f"⏳ Flood limit, retry in {e.retry_after}s")
+                    await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"❌ Queued message to {item.get('chat_id')} failed: {e}")
+        finally:
+            _SEND_Q.task_done()
 
 # ------ Database Manager ------
+def public_fields(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Строка таблицы без служебных полей (_photos, _card_*), посчитанных при загрузке"""
+    return {k: v for k, v in row.items() if not str(k).startswith("_")}
+
 class DatabaseManager:
     def __init__(self, db_path: str):
         self.db_path = db_path
@@ -215,7 +324,7 @@ class DatabaseManager:
                 cursor = conn.cursor()
                 cursor.execute(
                     "INSERT INTO user_actions (uid, action, data) VALUES (?, ?, ?)",
-                    (uid, action, json.dumps(data) if data else None)
+                    (uid, action, json_dumps(data) if data else None)
                 )
         except Exception as e:
             logger.error(f"Failed to log action: {e}")
@@ -248,7 +357,7 @@ class DatabaseManager:
                 cursor = conn.cursor()
                 cursor.execute(
                     "INSERT INTO leads (uid, name, phone, ad_data) VALUES (?, ?, ?, ?)",
-                    (uid, name, phone, json.dumps(ad_data))
+                    (uid, name, phone, json_dumps(public_fields(ad_data)))
                 )
         except Exception as e:
             logger.error(f"Failed to log lead: {e}")
@@ -259,7 +368,7 @@ class DatabaseManager:
                 cursor = conn.cursor()
                 cursor.execute(
                     "INSERT INTO favorites (uid, action, ad_data) VALUES (?, ?, ?)",
-                    (uid, action, json.dumps(ad_data))
+                    (uid, action, json_dumps(public_fields(ad_data)))
                 )
         except Exception as e:
             logger.error(f"Failed to log favorite: {e}")
@@ -275,6 +384,18 @@ class DatabaseManager:
         except Exception as e:
             logger.error(f"Failed to register user: {e}")
     
+    def prune_actions(self, days: int) -> int:
+        """Удаляет события user_actions старше days дней"""
+        try:
+            cutoff_str = (datetime.utcnow() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM user_actions WHERE timestamp < ?", (cutoff_str,))
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Failed to prune actions: {e}")
+            return 0
+    
     def get_stats(self, days: int = 1) -> Dict[str, Any]:
         try:
             cutoff = datetime.utcnow() - timedelta(days=days)
@@ -295,17 +416,13 @@ class DatabaseManager:
                 )
                 new_users = cursor.fetchone()[0]
                 
+                # Количество и средний результат поиска — одним проходом по searches
                 cursor.execute(
-                    "SELECT COUNT(*) FROM user_actions WHERE timestamp >= ?",
-                    (cutoff_str,)
-                )
-                total_actions = cursor.fetchone()[0]
-                
-                cursor.execute(
-                    "SELECT COUNT(*) FROM searches WHERE timestamp >= ?",
+                    "SELECT COUNT(*), AVG(CASE WHEN results_count > 0 THEN results_count END) FROM searches WHERE timestamp >= ?",
                     (cutoff_str,)
                 )
-                searches_count = cursor.fetchone()[0]
+                searches_count, avg_results = cursor.fetchone()
+                avg_results = avg_results or 0
                 
                 cursor.execute(
                     "SELECT COUNT(*) FROM leads WHERE timestamp >= ?",
@@ -314,22 +431,18 @@ class DatabaseManager:
                 leads_count = cursor.fetchone()[0]
                 
                 cursor.execute(
-                    "SELECT COUNT(*) FROM favorites WHERE action = 'add' AND timestamp >= ?",
+                    "SELECT COALESCE(SUM(action = 'add'), 0), COALESCE(SUM(action = 'remove'), 0) FROM favorites WHERE timestamp >= ?",
                     (cutoff_str,)
                 )
-                favorites_added = cursor.fetchone()[0]
-                
-                cursor.execute(
-                    "SELECT COUNT(*) FROM favorites WHERE action = 'remove' AND timestamp >= ?",
-                    (cutoff_str,)
-                )
-                favorites_removed = cursor.fetchone()[0]
+                favorites_added, favorites_removed = cursor.fetchone()
                 
                 cursor.execute(
                     "SELECT action, COUNT(*) as count FROM user_actions WHERE timestamp >= ? GROUP BY action",
                     (cutoff_str,)
                 )
                 action_counts = {row['action']: row['count'] for row in cursor.fetchall()}
+                # Общее число действий — сумма по группам, без отдельного COUNT(*)
+                total_actions = sum(action_counts.values())
                 
                 cursor.execute(
                     "SELECT mode, COUNT(*) as count FROM searches WHERE timestamp >= ? AND mode != '' GROUP BY mode",
@@ -343,12 +456,6 @@ class DatabaseManager:
                 )
                 city_counts = {row['city']: row['count'] for row in cursor.fetchall()}
                 
-                cursor.execute(
-                    "SELECT AVG(results_count) FROM searches WHERE timestamp >= ? AND results_count > 0",
-                    (cutoff_str,)
-                )
-                avg_results = cursor.fetchone()[0] or 0
-                
                 conversion_rate = (leads_count / searches_count * 100) if searches_count > 0 else 0
                 
                 return {
@@ -426,48 +533,179 @@ class SheetsManager:
         if not creds_json:
             raise RuntimeError("GOOGLE_CREDENTIALS_JSON is missing")
         creds = Credentials.from_service_account_info(
-            json.loads(creds_json),
+            json_loads(creds_json),
             scopes=[
                 "https://www.googleapis.com/auth/spreadsheets.readonly",
                 "https://www.googleapis.com/auth/drive.readonly",
             ],
         )
-        self.client = gspread.authorize(creds)
+        # Одна HTTP-сессия на все обновления: TCP/TLS переиспользуются, временные 429/5xx повторяются
+        http = AuthorizedSession(creds)
+        http.mount("https://", HTTPAdapter(
+            pool_connections=4, pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+        ))
+        self.client = gspread.authorize(creds, session=http)
+        self._http = http
         self.sheet_id = Config.GSHEET_ID
         self.tab_name = Config.GSHEET_TAB or "Ads"
+        self._spreadsheet = None
+        self._check_modified = Config.GSHEET_CHECK_MODIFIED
+        self.last_modified: Optional[str] = None
+
+    def modified_time(self) -> Optional[str]:
+        """modifiedTime файла из Drive API — маленький запрос вместо выгрузки всей таблицы"""
+        if not self._check_modified:
+            return None
+        try:
+            resp = self._http.get(
+                f"https://www.googleapis.com/drive/v3/files/{self.sheet_id}",
+                params={"fields": "modifiedTime", "supportsAllDrives": "true"},
+                timeout=10,
+            )
+            if resp.status_code in (403, 404):
+                # Drive API не включён или нет доступа к файлу — больше не пробуем, грузим таблицу как раньше
+                logger.warning(f"⚠️ Drive modifiedTime unavailable ({resp.status_code}), always reloading sheet")
+                self._check_modified = False
+                return None
+            resp.raise_for_status()
+            return resp.json().get("modifiedTime")
+        except Exception as e:
+            # Таймаут, 5xx и т.п. — в этот раз просто выгружаем таблицу
+            logger.warning(f"⚠️ Drive modifiedTime request failed: {e}")
+            return None
 
     def get_rows(self) -> List[Dict[str, Any]]:
-        ws = self.client.open_by_key(self.sheet_id).worksheet(self.tab_name)
-        rows = ws.get_all_records()
+        # Один запрос values.batchGet вместо get_all_records (метаданные + поячеечная обработка)
+        if self._spreadsheet is None:
+            self._spreadsheet = self.client.open_by_key(self.sheet_id)
+        # Весь лист без жёсткой границы колонок: API сам обрезает ответ по последней заполненной колонке/строке,
+        # а новая колонка в таблице не потеряется молча. Апостроф в имени листа удваивается (A1-нотация)
+        resp = self._spreadsheet.values_batch_get(["'" + self.tab_name.replace("'", "''") + "'"])
+        ranges = resp.get("valueRanges") or [{}]
+        values = ranges[0].get("values") or []
+        if not values:
+            return []
+        # Ключи общие для всех строк — одна строка-объект на колонку
+        headers = tuple(sys.intern(str(h)) for h in values[0])
+        width = len(headers)
+        rows = [dict(zip(headers, v + [""] * (width - len(v)))) for v in values[1:]]
         logger.info(f"✅ Loaded {len(rows)} rows from Sheets [{self.tab_name}]")
         return rows
 
 sheets = SheetsManager()
 
 # ------ Cache rows ------
-_cached_rows: List[Dict[str, Any]] = []
+# Строки и колоночный индекс по ним — один объект: новое поколение публикуется одним присваиванием,
+# и хендлер не увидит строки одного поколения с индексом другого
+_INDEX: Dict[str, Any] = {}
+_index_gen = 0
 _cache_ts: float = 0.0
 
+def cached_rows() -> List[Dict[str, Any]]:
+    return _INDEX.get("rows", [])
+
+def _publish(data: List[Dict[str, Any]]) -> None:
+    global _INDEX, _index_gen
+    index = build_index(data)
+    _index_gen += 1
+    index["gen"] = _index_gen
+    # Предыдущее поколение держим, пока хендлер со старыми строками не закончит работу после await
+    prev = _INDEX
+    prev.pop("prev", None)
+    index["prev"] = prev
+    _INDEX = index
+
+def _save_snapshot(data: List[Dict[str, Any]]) -> None:
+    """Копия таблицы на диск, чтобы после рестарта не ждать Sheets"""
+    path = Config.CACHE_SNAPSHOT_PATH
+    if not path:
+        return
+    try:
+        tmp = f"{path}.tmp"
+        # Пишем во временный файл (права 0600) и атомарно подменяем — рестарт не застанет обрезанный снимок
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+            f.write(json_dumps(data))
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to save cache snapshot: {e}")
+
+def load_snapshot() -> bool:
+    global _cache_ts
+    path = Config.CACHE_SNAPSHOT_PATH
+    if not path or not os.path.exists(path):
+        return False
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json_loads(f.read())
+        for r in data:
+            prepare_row(r)
+        _publish(data)
+        # Снимок считаем устаревшим: первый же запрос обновит его в фоне
+        _cache_ts = monotonic() - Config.GSHEET_REFRESH_SEC
+        logger.info(f"💾 Cache restored from snapshot: {len(data)} rows")
+        return True
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to load cache snapshot: {e}")
+        return False
+
 def load_rows(force: bool = False) -> List[Dict[str, Any]]:
-    global _cached_rows, _cache_ts
-    if not force and _cached_rows and (monotonic() - _cache_ts) < Config.GSHEET_REFRESH_SEC:
-        return _cached_rows
+    global _cache_ts
+    rows = cached_rows()
+    if not force and rows and (monotonic() - _cache_ts) < Config.GSHEET_REFRESH_SEC:
+        return rows
     try:
+        # Берём modifiedTime до выгрузки: правка во время загрузки не будет ошибочно считаться учтённой
+        modified = sheets.modified_time()
+        if not force and rows and modified is not None and modified == sheets.last_modified:
+            # Таблица не менялась — продлеваем кэш без выгрузки
+            _cache_ts = monotonic()
+            return rows
         data = sheets.get_rows()
-        _cached_rows = data
+        sheets.last_modified = modified
+        _save_snapshot(data)
+        for r in data:
+            prepare_row(r)
+        _publish(data)
         _cache_ts = monotonic()
         logger.info(f"📦 Cache updated: {len(data)} rows")
         return data
     except Exception as e:
         logger.exception(f"❌ Failed to load rows from Sheets: {e}")
-        return _cached_rows or []
+        return cached_rows()
+
+_refresh_lock = asyncio.Lock()
+_refresh_task: Optional[asyncio.Task] = None
+# Свой поток для Sheets: долгая загрузка не занимает общий пул to_thread (БД и прочее)
+_SHEETS_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets")
+
+async def _load_rows_async(force: bool) -> List[Dict[str, Any]]:
+    rows = await asyncio.get_running_loop().run_in_executor(_SHEETS_POOL, load_rows, force)
+    # Уже на event loop: USER_RESULTS трогаем только отсюда
+    _detach_stale_results()
+    return rows
+
+async def _bg_refresh() -> None:
+    async with _refresh_lock:
+        await _load_rows_async(False)
 
 async def rows_async(force: bool = False) -> List[Dict[str, Any]]:
-    return await asyncio.to_thread(load_rows, force)
+    """Stale-while-revalidate: устаревший кэш отдаём сразу, обновляем в фоне"""
+    global _refresh_task
+    if force:
+        async with _refresh_lock:
+            return await _load_rows_async(True)
+    age = monotonic() - _cache_ts
+    rows = cached_rows()
+    if not rows or age >= Config.GSHEET_HARD_TTL_SEC:
+        async with _refresh_lock:
+            return await _load_rows_async(False)
+    if age >= Config.GSHEET_REFRESH_SEC and (_refresh_task is None or _refresh_task.done()):
+        _refresh_task = asyncio.create_task(_bg_refresh())
+    return rows
 
 # ------ Localization ------
 LANGS = ["ru", "en", "ka"]
-USER_LANG: Dict[int, str] = {}
 LANG_MAP = {"ru":"ru","ru-RU":"ru","en":"en","en-US":"en","en-GB":"en","ka":"ka","ka-GE":"ka"}
 
 T = {
@@ -504,25 +742,39 @@ T = {
     },
 }
 
+# Строки одного языка в плоском пространстве имён: LOCALES[lang].btn_back вместо T["btn_back"][lang]
+LOCALES: Dict[str, SimpleNamespace] = {
+    lang: SimpleNamespace(**{key: texts.get(lang, texts.get("ru", key)) for key, texts in T.items()})
+    for lang in LANGS
+}
+
 LANG_FIELDS = {
     "ru": {"title": "title_ru", "desc": "description_ru"},
     "en": {"title": "title_en", "desc": "description_en"},
     "ka": {"title": "title_ka", "desc": "description_ka"},
 }
 
+def button_texts(key: str) -> frozenset:
+    """Подписи кнопки на всех языках — для фильтров F.text.in_"""
+    return frozenset(T[key][lang] for lang in LANGS)
+
+# «Пропустить» на любом языке, в нижнем регистре
+_SKIP_WORDS = frozenset(text.lower() for text in button_texts("btn_skip"))
+
 def t(lang: str, key: str, **kw) -> str:
-    lang = lang if lang in LANGS else "ru"
-    val = T.get(key, {}).get(lang, T.get(key, {}).get("ru", key))
+    val = getattr(LOCALES.get(lang) or LOCALES["ru"], key, key)
     try:
         return val.format(**kw) if kw else val
     except Exception:
         return val
 
 def current_lang(uid: int) -> str:
-    return USER_LANG.get(uid, "ru")
+    st = USERS.get(uid)
+    return (st.lang if st else None) or "ru"
 
-def main_menu(lang: str) -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
+# Статичные клавиатуры собираем один раз на язык
+_MAIN_MENU: Dict[str, ReplyKeyboardMarkup] = {
+    lang: ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text=T["btn_fast"][lang])],
             [KeyboardButton(text=T["btn_search"][lang]), KeyboardButton(text=T["btn_latest"][lang])],
@@ -531,6 +783,52 @@ def main_menu(lang: str) -> ReplyKeyboardMarkup:
         ],
         resize_keyboard=True
     )
+    for lang in LANGS
+}
+
+_MODE_KB: Dict[str, ReplyKeyboardMarkup] = {
+    lang: ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text=T["btn_rent"][lang])],
+            [KeyboardButton(text=T["btn_sale"][lang])],
+            [KeyboardButton(text=T["btn_daily"][lang])],
+            [KeyboardButton(text=T["btn_back"][lang])]
+        ],
+        resize_keyboard=True
+    )
+    for lang in LANGS
+}
+
+_PRICE_METHOD_KB: Dict[str, ReplyKeyboardMarkup] = {
+    lang: ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text=T["btn_standard_ranges"][lang])],
+            [KeyboardButton(text=T["btn_custom_price"][lang])],
+            [KeyboardButton(text=T["btn_back"][lang])]
+        ],
+        resize_keyboard=True
+    )
+    for lang in LANGS
+}
+
+_LANG_KB = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text=l.upper(), callback_data=f"lang:{l}")] for l in LANGS]
+)
+
+def main_menu(lang: str) -> ReplyKeyboardMarkup:
+    return _MAIN_MENU[lang if lang in _MAIN_MENU else "ru"]
+
+_ROOMS_KB: Dict[str, ReplyKeyboardMarkup] = {
+    lang: ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="1"), KeyboardButton(text="2"), KeyboardButton(text="3")],
+            [KeyboardButton(text="4"), KeyboardButton(text="5+")],
+            [KeyboardButton(text=T["btn_skip"][lang]), KeyboardButton(text=T["btn_back"][lang])]
+        ],
+        resize_keyboard=True
+    )
+    for lang in LANGS
+}
 
 # ------ Icons & price ranges ------
 CITY_ICONS = {
@@ -544,42 +842,96 @@ PRICE_RANGES = {
     "daily": ["Пропустить"]
 }
 
+_DIGITS_RE = re.compile(r"[^\d]")
+_DIGITS_DOT_RE = re.compile(r"[^\d.]")
+
+def _parse_price_range(label: str) -> Tuple[Optional[float], Optional[float]]:
+    """'500$-700$' -> (500, 700), '300$-' -> (300, None), '900' -> (None, 900)"""
+    if "-" in label:
+        left, _, right = label.partition("-")
+        lo = float(_DIGITS_RE.sub("", left) or "0")
+        hi = float(_DIGITS_RE.sub("", right) or "0")
+        return lo, (hi or None)
+    try:
+        cap = float(_DIGITS_DOT_RE.sub("", label) or "0")
+    except ValueError:
+        return None, None
+    return None, (cap or None)
+
+# Границы стандартных диапазонов разбираем один раз при импорте
+_PRICE_BUCKETS: Dict[str, Dict[str, Tuple[Optional[float], Optional[float]]]] = {
+    mode: {label: _parse_price_range(label) for label in ranges}
+    for mode, ranges in PRICE_RANGES.items()
+}
+
+_PRICE_KB: Dict[Tuple[str, str], ReplyKeyboardMarkup] = {
+    (mode, lang): ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=p)] for p in ranges] + [
+            [KeyboardButton(text=T["btn_skip"][lang])],
+            [KeyboardButton(text=T["btn_back"][lang])]
+        ],
+        resize_keyboard=True
+    )
+    for mode, ranges in PRICE_RANGES.items()
+    for lang in LANGS
+}
+
+def price_bounds(mode: str, label: str) -> Tuple[Optional[float], Optional[float]]:
+    bounds = _PRICE_BUCKETS.get(mode, {}).get(label)
+    return bounds if bounds is not None else _parse_price_range(label)
+
 # ------ Utilities ------
+_MODE_JUNK_RE = re.compile(r'[^\w\s-]')
+_BTN_ICON_RE = re.compile(r"^[\U0001F300-\U0001F9FF\s]+")
+_BTN_COUNT_RE = re.compile(r"\s*\(\d+\)\s*$")
+_DRIVE_D_RE = re.compile(r"/d/([A-Za-z0-9_-]{20,})/")
+_DRIVE_ID_RE = re.compile(r"[?&]id=([A-Za-z0-9_-]{20,})")
+
+_now_sec = -1
+_now_iso_str = ""
+
+def now_iso() -> str:
+    """UTC-время ISO-строкой с точностью до секунды; в пределах секунды строка переиспользуется"""
+    global _now_sec, _now_iso_str
+    sec = int(time.time())
+    if sec != _now_sec:
+        _now_iso_str = "%04d-%02d-%02dT%02d:%02d:%02d" % time.gmtime(sec)[:6]
+        _now_sec = sec
+    return _now_iso_str
+
 def norm(s: Any) -> str:
     result = str(s or "").strip().lower()
     result = " ".join(result.split())
     return result
 
+_MODE_ALIAS: Dict[str, str] = {
+    **dict.fromkeys(("rent", "аренда", "long", "longterm", "long-term", "долгосрочно"), "rent"),
+    **dict.fromkeys(("sale", "продажа", "buy", "sell"), "sale"),
+    **dict.fromkeys(("daily", "посуточно", "sutki", "сутки", "short", "shortterm", "short-term", "day"), "daily"),
+}
+
 def norm_mode(v: Any) -> str:
-    s = norm(v)
-    s = re.sub(r'[^\w\s-]', '', s)
-    s = s.strip()
-    
-    if s in {"rent","аренда","long","longterm","долгосрочно"}: 
-        return "rent"
-    if s in {"sale","продажа","buy","sell"}: 
-        return "sale"
-    if s in {"daily","посуточно","sutki","сутки","short","shortterm","day"}: 
-        return "daily"
-    return ""
+    return _MODE_ALIAS.get(_MODE_JUNK_RE.sub('', norm(v)).strip(), "")
 
 def clean_button_text(text: str) -> str:
-    text = re.sub(r"^[\U0001F300-\U0001F9FF\s]+", "", text)
-    text = re.sub(r"\s*\(\d+\)\s*$", "", text)
+    text = _BTN_ICON_RE.sub("", text)
+    text = _BTN_COUNT_RE.sub("", text)
     return text.strip()
 
 def drive_direct(url: str) -> str:
     if not url: return url
-    m = re.search(r"/d/([A-Za-z0-9_-]{20,})/", url)
-    if m: return f"https://drive.google.com/uc?export=download&id={m.group(1)}"
-    m = re.search(r"[?&]id=([A-Za-z0-9_-]{20,})", url)
+    # Обычные ссылки на картинки не содержат ни /d/, ни id= — регэкспы не нужны
+    if "/d/" not in url and "id=" not in url: return url
+    m = _DRIVE_D_RE.search(url) or _DRIVE_ID_RE.search(url)
     if m: return f"https://drive.google.com/uc?export=download&id={m.group(1)}"
     return url
 
+_IMG_SUFFIXES = (".jpg", ".jpeg", ".png", ".webp")
+
 def looks_like_image(url: str) -> bool:
     if not url: return False
     u = url.lower()
-    return any(u.endswith(ext) for ext in (".jpg",".jpeg",".png",".webp")) or \
+    return u.endswith(_IMG_SUFFIXES) or \
            "googleusercontent.com" in u or "google.com/uc?export=download" in u
 
 def is_valid_photo_url(url: str) -> bool:
@@ -595,39 +947,77 @@ def is_valid_photo_url(url: str) -> bool:
     except Exception:
         return False
 
+_PHOTO_COLS: Tuple[str, ...] = tuple(f"photo{i}" for i in range(1, 11))
+
 def collect_photos(row: Dict[str, Any]) -> List[str]:
     out = []
-    for i in range(1, 11):
-        u = str(row.get(f"photo{i}", "") or "").strip()
-        if not u: 
+    for col in _PHOTO_COLS:
+        u = row.get(col)
+        if not u:
+            continue
+        # Ячейки Sheets уже строки — str() только для прочих значений
+        u = (u if isinstance(u, str) else str(u)).strip()
+        if not u:
             continue
         u = drive_direct(u)
         if is_valid_photo_url(u):
             out.append(u)
         else:
             logger.warning(f"⚠️ Invalid photo URL: {u[:50]}...")
-    return out[:10]
+    return out
+
+_STUDIO_ALIASES = frozenset(("студия", "studio", "stud", "სტუდიო"))
 
 def parse_rooms(v: Any) -> float:
     s = str(v or "").strip().lower()
-    if s in {"студия","studio","stud","სტუდიო"}: return 0.5
+    if s in _STUDIO_ALIASES: return 0.5
     try:
         return float(s.replace("+",""))
     except Exception:
         return -1.0
 
+_UTM_KEY = Config.UTM_SECRET.encode()[:64]
+
+@lru_cache(maxsize=4096)
+def _utm_token(uid: int, day: str, ad_id: str) -> str:
+    # Токен только помечает переход: 8 байт BLAKE2b (16 hex), с UTM_SECRET его не подделать
+    return blake2b(f"{uid}:{day}:{ad_id}".encode(), digest_size=8, key=_UTM_KEY).hexdigest()
+
+@lru_cache(maxsize=256)
+def _split_url(raw: str) -> Tuple[Any, Dict[str, List[str]]]:
+    """Ссылки рекламы фиксированные — разбираем каждую один раз"""
+    u = urlparse(raw)
+    return u, parse_qs(u.query)
+
+_UTM_FIXED = urlencode({"utm_source": Config.UTM_SOURCE, "utm_medium": Config.UTM_MEDIUM, "utm_campaign": Config.UTM_CAMPAIGN})
+
 def build_utm_url(raw: str, ad_id: str, uid: int) -> str:
     if not raw: return raw or ""
-    u = urlparse(raw)
-    q = parse_qs(u.query)
+    token = _utm_token(uid, now_iso()[:10].replace("-", ""), ad_id)
+    # Обычная ссылка без query/фрагмента — просто дописываем параметры
+    if "?" not in raw and "#" not in raw and ";" not in raw:
+        return f"{raw}?{_UTM_FIXED}&utm_content={quote_plus(ad_id)}&token={token}"
+    u, parsed = _split_url(raw)
+    q = dict(parsed)
     q["utm_source"] = [Config.UTM_SOURCE]
     q["utm_medium"] = [Config.UTM_MEDIUM]
     q["utm_campaign"] = [Config.UTM_CAMPAIGN]
     q["utm_content"] = [ad_id]
-    q["token"] = [__import__("hashlib").sha256(f"{uid}:{datetime.utcnow().strftime('%Y%m%d')}:{ad_id}".encode()).hexdigest()[:16]]
+    q["token"] = [token]
     new_q = urlencode({k: v[0] for k, v in q.items()})
     return urlunparse((u.scheme, u.netloc, u.path, u.params, new_q, u.fragment))
 
+@lru_cache(maxsize=8192)
+def published_date(published: str) -> str:
+    """Дата публикации как YYYY-MM-DD; одна и та же строка разбирается один раз"""
+    # Явно не дата — не доходим до исключения в fromisoformat
+    if len(published) < 8 or not published[:4].isdigit():
+        return published
+    try:
+        return datetime.fromisoformat(published).strftime("%Y-%m-%d")
+    except ValueError:
+        return published
+
 def format_card(row: Dict[str, Any], lang: str) -> str:
     title_k = LANG_FIELDS[lang]["title"]
     desc_k  = LANG_FIELDS[lang]["desc"]
@@ -641,12 +1031,7 @@ def format_card(row: Dict[str, Any], lang: str) -> str:
     title    = str(row.get(title_k,"")).strip()
     desc     = str(row.get(desc_k,"")).strip()
 
-    pub_txt = published
-    try:
-        dt = datetime.fromisoformat(published)
-        pub_txt = dt.strftime("%Y-%m-%d")
-    except Exception:
-        pass
+    pub_txt = published_date(published)
 
     lines = []
     if title: lines.append(f"<b>{title}</b>")
@@ -659,6 +1044,19 @@ def format_card(row: Dict[str, Any], lang: str) -> str:
     if not desc and not phone: lines.append("—")
     return "\n".join(lines)
 
+def prepare_row(row: Dict[str, Any]) -> None:
+    """Фото и карточки на всех языках считаем один раз при загрузке таблицы"""
+    row["_photos"] = tuple(collect_photos(row))
+    for lang in LANGS:
+        row[f"_card_{lang}"] = format_card(row, lang)
+
+def row_photos(row: Dict[str, Any]) -> List[str]:
+    photos = row.get("_photos")
+    return list(photos) if photos is not None else collect_photos(row)
+
+def card_text(row: Dict[str, Any], lang: str) -> str:
+    return row.get(f"_card_{lang}") or format_card(row, lang)
+
 # ------ FSM ------
 class Wizard(StatesGroup):
     mode = State()
@@ -672,13 +1070,63 @@ class Wizard(StatesGroup):
 
 # ------ User data ------
 PAGE_SIZE = 8
-USER_RESULTS: Dict[int, Dict[str, Any]] = {}
-USER_FAVS: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
-USER_CURRENT_INDEX: Dict[int, int] = {}
-USER_LEAD_STATE: Dict[int, str] = {}
-USER_LEAD_DATA: Dict[int, Dict[str, Any]] = {}
-LAST_AD_TIME: Dict[int, float] = {}
-LAST_AD_ID: Dict[int, str] = {}
+
+class UserState:
+    """Долгоживущие данные пользователя в одном объекте со слотами"""
+    __slots__ = ("lang", "favs", "last_ad_time", "last_ad_id", "ad_acc")
+
+    def __init__(self):
+        self.lang: Optional[str] = None
+        # Избранное: индекс карточки -> строка, в порядке добавления
+        self.favs: Dict[int, Dict[str, Any]] = {}
+        self.last_ad_time: float = 0.0
+        self.last_ad_id: Optional[str] = None
+        self.ad_acc: float = 0.0
+
+class UserStates(LRUCache):
+    """LRU по пользователям: давно неактивные вытесняются, новый uid получает пустой UserState"""
+
+    def __missing__(self, uid: int) -> UserState:
+        st = self[uid] = UserState()
+        return st
+
+USERS: UserStates = UserStates(maxsize=Config.USER_CACHE_MAX)
+
+def user_favs(uid: int) -> Dict[int, Dict[str, Any]]:
+    """Избранное только для чтения: не создаёт UserState для тех, кто ничего не добавлял"""
+    st = USERS.get(uid)
+    return st.favs if st is not None else {}
+# Сессионные данные живут ограниченное время, чтобы брошенные сессии не копились в памяти
+USER_RESULTS: TTLCache = TTLCache(maxsize=Config.USER_CACHE_MAX, ttl=Config.USER_TTL_SEC)
+USER_CURRENT_INDEX: TTLCache = TTLCache(maxsize=Config.USER_CACHE_MAX, ttl=Config.USER_TTL_SEC)
+USER_LEAD_STATE: TTLCache = TTLCache(maxsize=Config.USER_CACHE_MAX, ttl=Config.LEAD_TTL_SEC)
+USER_LEAD_DATA: TTLCache = TTLCache(maxsize=Config.USER_CACHE_MAX, ttl=Config.LEAD_TTL_SEC)
+
+def _generation_of(rows: List[Dict[str, Any]]) -> Optional[int]:
+    index = _INDEX
+    prev = index.get("prev") or {}
+    for idx in (index, prev):
+        if idx.get("rows") is rows:
+            return idx["gen"]
+    return None
+
+def make_results(query: Dict[str, Any], snapshot: List[Dict[str, Any]], row_ids: Sequence[int]) -> Dict[str, Any]:
+    """Результаты пользователя: индексы в общем списке строк вместо копий строк"""
+    # gen — поколение кэша, на которое ссылается snapshot; None — собственный список (избранное)
+    return {"query": query, "snapshot": snapshot, "row_ids": row_ids, "page": 0, "gen": _generation_of(snapshot)}
+
+def _detach_stale_results() -> None:
+    """После обновления кэша выдачи прошлых поколений оставляют себе только свои строки, а не всю таблицу"""
+    gen = _INDEX.get("gen")
+    for bundle in list(USER_RESULTS.values()):
+        if bundle["gen"] is not None and bundle["gen"] != gen:
+            snapshot = bundle["snapshot"]
+            bundle["snapshot"] = [snapshot[i] for i in bundle["row_ids"]]
+            bundle["row_ids"] = range(len(bundle["snapshot"]))
+            bundle["gen"] = None
+
+def result_row(bundle: Dict[str, Any], index: int) -> Dict[str, Any]:
+    return bundle["snapshot"][bundle["row_ids"][index]]
 
 # ------ Ads ------
 ADS = [
@@ -687,13 +1135,19 @@ ADS = [
 ]
 
 def should_show_ad(uid: int) -> bool:
-    if not Config.ADS_ENABLED or not ADS: return False
-    now = time.time()
-    if now - LAST_AD_TIME.get(uid,0.0) < Config.ADS_COOLDOWN_SEC: return False
-    return random.random() < Config.ADS_PROB
+    if not Config.ADS_ENABLED or not ADS or Config.ADS_PROB <= 0: return False
+    st = USERS[uid]
+    if time.time() - st.last_ad_time < Config.ADS_COOLDOWN_SEC: return False
+    # Вместо броска монетки — накопитель: ровно ADS_PROB показов на подходящий раз после кулдауна
+    st.ad_acc += Config.ADS_PROB
+    if st.ad_acc < 1: return False
+    st.ad_acc -= 1
+    return True
 
 def pick_ad(uid: int) -> Dict[str, Any]:
-    pool = [a for a in ADS if a.get("id") != LAST_AD_ID.get(uid)] or ADS
+    st = USERS.get(uid)
+    last_id = st.last_ad_id if st else None
+    pool = [a for a in ADS if a.get("id") != last_id] or ADS
     return random.choice(pool)
 
 async def maybe_show_ad_by_chat(chat_id: int, uid: int):
@@ -701,12 +1155,11 @@ async def maybe_show_ad_by_chat(chat_id: int, uid: int):
     ad = pick_ad(uid)
     url = build_utm_url(ad.get("url",""), ad.get("id","ad"), uid)
     kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="👉 Подробнее", url=url)]])
-    try:
-        await bot.send_message(chat_id, ad.get("text_ru","LivePlace"), reply_markup=kb)
-    except Exception:
-        pass
-    LAST_AD_TIME[uid] = time.time()
-    LAST_AD_ID[uid] = ad.get("id")
+    # Реклама — фоновая отправка: через общую очередь и лимитер, ошибки логирует send_worker
+    await queue_message(chat_id, ad.get("text_ru","LivePlace"), reply_markup=kb)
+    st = USERS[uid]
+    st.last_ad_time = time.time()
+    st.last_ad_id = ad.get("id")
 
 # ------ 🎉 Анимация лайков с сердечками ------
 async def send_like_animation(chat_id: int, message_id: int, uid: int):
@@ -729,111 +1182,225 @@ async def send_like_animation(chat_id: int, message_id: int, uid: int):
             logger.error(f"❌ Failed to send sticker: {e}")
 
 # ------ Filtering ------
-def _filter_rows(rows: List[Dict[str, Any]], q: Dict[str, Any]) -> List[Dict[str, Any]]:
-    def ok(r):
-        if q.get("mode"):
-            row_mode = norm_mode(r.get("mode"))
-            query_mode = norm_mode(q["mode"])
-            if row_mode != query_mode:
-                return False
-        
-        if q.get("city") and q["city"].strip():
-            row_city = norm(r.get("city"))
-            query_city = norm(q["city"])
-            if row_city != query_city:
-                return False
-        
-        if q.get("district") and q["district"].strip():
-            row_district = norm(r.get("district"))
-            query_district = norm(q["district"])
-            if row_district != query_district:
-                return False
-        
-        if q.get("rooms") and q["rooms"].strip():
-            try:
-                need = float(q["rooms"].replace("+", ""))
-                have = parse_rooms(r.get("rooms"))
-                if have < 0:
-                    return False
-                if "+" in str(q["rooms"]):
-                    if have < need:
-                        return False
-                else:
-                    if int(need) != int(have) and not (need == 0.5 and have == 0.5):
-                        return False
-            except Exception:
-                pass
-        
-        if q.get("price_min") is not None or q.get("price_max") is not None:
-            try:
-                p = float(re.sub(r"[^\d.]", "", str(r.get("price", "")) or "0") or 0)
-                if p == 0:
-                    return True
-                
-                min_val = q.get("price_min")
-                max_val = q.get("price_max")
-                
-                if min_val is not None and p < min_val:
-                    return False
-                if max_val is not None and p > max_val:
-                    return False
-            except Exception:
-                pass
-        
-        elif q.get("price") and q["price"].strip() and q["price"].lower() not in {"пропустить", "skip", "გამოტოვება"}:
-            try:
-                pr = str(q["price"])
-                if "-" in pr:
-                    parts = pr.split("-", 1)
-                    left = parts[0]
-                    right = parts[1] if len(parts) > 1 else ""
-                    
-                    left_val = float(re.sub(r"[^\d]", "", left) or "0")
-                    right_val = float(re.sub(r"[^\d]", "", right) or "0") if right else 0
-                    
-                    p = float(re.sub(r"[^\d.]", "", str(r.get("price", "")) or "0") or 0)
-                    
-                    if p == 0:
-                        return True
-                    
-                    if right_val == 0:
-                        if p < left_val:
-                            return False
-                    else:
-                        if p < left_val or p > right_val:
-                            return False
-                else:
-                    cap = float(re.sub(r"[^\d.]", "", pr) or "0")
-                    p = float(re.sub(r"[^\d.]", "", str(r.get("price", "")) or "0") or 0)
-                    if p > cap and cap > 0:
-                        return False
-            except Exception:
-                pass
-        
-        return True
+# Колоночный индекс по строкам кэша (_INDEX) строится один раз при загрузке из Sheets
+_FILTER_MEMO_MAX = 256
+LATEST_COUNT = 20
+
+def _row_price(r: Dict[str, Any]) -> float:
+    try:
+        return float(_DIGITS_DOT_RE.sub("", str(r.get("price", "")) or "0") or 0)
+    except ValueError:
+        return 0.0
+
+def build_index(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    by_mcd: Dict[Tuple[str, str, str], List[int]] = defaultdict(list)
+    by_mc: Dict[Tuple[str, str], List[int]] = defaultdict(list)
+    by_m: Dict[str, List[int]] = defaultdict(list)
+    city_keys: List[Tuple[str, str]] = []
+    district_keys: List[Tuple[Tuple[str, str], str]] = []
+    for i, r in enumerate(rows):
+        # Словарь режимов/городов/районов маленький — интернируем, чтобы равные строки были одним объектом
+        for field in ("mode", "city", "district"):
+            if isinstance(r.get(field), str):
+                r[field] = sys.intern(r[field])
+        mode, city = sys.intern(norm_mode(r.get("mode"))), sys.intern(norm(r.get("city")))
+        by_mcd[(mode, city, sys.intern(norm(r.get("district"))))].append(i)
+        by_mc[(mode, city)].append(i)
+        by_m[mode].append(i)
+        # Счётчики для кнопок городов/районов — подписи берём как в таблице
+        if r.get("city"):
+            city_keys.append((mode, sys.intern(str(r.get("city", "")).strip())))
+        if r.get("district"):
+            district_keys.append(((mode, city), sys.intern(str(r.get("district", "")).strip())))
+    # Считаем одним проходом Counter (цикл на C), потом раскладываем по режимам/городам
+    cities: Dict[str, Counter] = defaultdict(Counter)
+    for (mode, label), n in Counter(city_keys).items():
+        cities[mode][label] = n
+    districts: Dict[Tuple[str, str], Counter] = defaultdict(Counter)
+    for (key, label), n in Counter(district_keys).items():
+        districts[key][label] = n
+    rooms = np.array([parse_rooms(r.get("rooms")) for r in rows], dtype=np.float64)
+    rooms[~np.isfinite(rooms)] = -1.0
+    return {
+        "rows": rows,
+        # Бакеты по (режим, город, район), (режим, город) и режиму; индексы внутри уже отсортированы
+        "by_mcd": {key: np.array(ids, dtype=np.intp) for key, ids in by_mcd.items()},
+        "by_mc": {key: np.array(ids, dtype=np.intp) for key, ids in by_mc.items()},
+        "by_m": {key: np.array(ids, dtype=np.intp) for key, ids in by_m.items()},
+        "price": np.array([_row_price(r) for r in rows], dtype=np.float64),
+        "rooms": rooms,
+        "cities": cities,
+        "districts": districts,
+        "memo": {},
+        "kb": {},
+        # Топ новых объявлений: nlargest даёт тот же порядок, что sorted(...)[:N], без полной сортировки
+        "latest": tuple(heapq.nlargest(LATEST_COUNT, range(len(rows)), key=lambda i: str(rows[i].get("published", "")))),
+    }
+
+def _index_for(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    index = _INDEX
+    if index.get("rows") is rows:
+        return index
+    prev = index.get("prev") or {}
+    if prev.get("rows") is rows:
+        return prev
+    logger.warning(f"⚠️ Rows are not from a cached generation, building a throwaway index ({len(rows)} rows)")
+    return build_index(rows)
+
+def latest_ids(rows: List[Dict[str, Any]]) -> Sequence[int]:
+    """Общий неизменяемый кортеж на всё поколение кэша — пользователи не копируют его себе"""
+    return _index_for(rows)["latest"]
+
+def district_counts(rows: List[Dict[str, Any]], mode: str, city: str) -> Counter:
+    return _index_for(rows)["districts"].get((mode, norm(city)), Counter())
+
+def city_keyboard(rows: List[Dict[str, Any]], mode: str, lang: str) -> ReplyKeyboardMarkup:
+    """Клавиатура городов живёт до следующего обновления кэша"""
+    index = _index_for(rows)
+    kbs = index["kb"]
+    key = ("city", mode, lang)
+    kb = kbs.get(key)
+    if kb is None:
+        buttons = []
+        for city, count in sorted(index["cities"].get(mode, Counter()).items(), key=lambda x: (-x[1], x[0].lower())):
+            icon = CITY_ICONS.get(norm(city), "🏠")
+            buttons.append([KeyboardButton(text=f"{icon} {city} ({count})")])
+        buttons.append([KeyboardButton(text=LOCALES[lang].btn_skip)])
+        buttons.append([KeyboardButton(text=LOCALES[lang].btn_back)])
+        kb = kbs[key] = ReplyKeyboardMarkup(keyboard=buttons[:42], resize_keyboard=True)
+    return kb
+
+def district_keyboard(rows: List[Dict[str, Any]], mode: str, city: str, lang: str) -> ReplyKeyboardMarkup:
+    index = _index_for(rows)
+    kbs = index["kb"]
+    key = ("district", mode, norm(city), lang)
+    kb = kbs.get(key)
+    if kb is None:
+        buttons = [[KeyboardButton(text=f"{d} ({c})")] for d,c in sorted(index["districts"].get((mode, norm(city)), Counter()).items(), key=lambda x:(-x[1], x[0].lower()))]
+        buttons.append([KeyboardButton(text=LOCALES[lang].btn_skip)])
+        buttons.append([KeyboardButton(text=LOCALES[lang].btn_back)])
+        kb = kbs[key] = ReplyKeyboardMarkup(keyboard=buttons[:42], resize_keyboard=True)
+    return kb
+
+def _filter_indices(rows: List[Dict[str, Any]], q: Dict[str, Any]) -> List[int]:
+    # Всё, что зависит только от запроса, разбираем один раз
+    mode = norm_mode(q["mode"]) if q.get("mode") else None
+    city = norm(q["city"]) if q.get("city") and q["city"].strip() else None
+    district = norm(q["district"]) if q.get("district") and q["district"].strip() else None
+    
+    rooms_need = rooms_int = None
+    rooms_plus = False
+    if q.get("rooms") and q["rooms"].strip():
+        try:
+            rooms_need = float(q["rooms"].replace("+", ""))
+            rooms_plus = "+" in str(q["rooms"])
+            rooms_int = int(rooms_need)
+        except (ValueError, OverflowError):
+            pass
     
-    filtered = [r for r in rows if ok(r)]
+    price_lo = price_hi = None
+    if q.get("price_min") is not None or q.get("price_max") is not None:
+        price_lo, price_hi = q.get("price_min"), q.get("price_max")
+    elif q.get("price") and q["price"].strip() and q["price"].lower() not in _SKIP_WORDS:
+        price_lo, price_hi = price_bounds(norm_mode(q.get("mode")), str(q["price"]))
+    check_price = price_lo is not None or price_hi is not None
+    
+    index = _index_for(rows)
+    # Запросы однотипные (режим/город/комнаты/цена из кнопок) — результат запоминаем до обновления индекса
+    key = (mode, city, district, rooms_need, rooms_plus, price_lo, price_hi)
+    cached = index["memo"].get(key)
+    if cached is not None:
+        logger.info(f"✅ Filtered {len(cached)}/{len(rows)} rows (cached)")
+        return list(cached)
+    
+    empty = np.empty(0, dtype=np.intp)
+    if mode is not None and city is not None and district is not None:
+        idx = index["by_mcd"].get((mode, city, district), empty)
+    elif mode is not None and city is not None:
+        idx = index["by_mc"].get((mode, city), empty)
+    elif mode is not None and district is None:
+        idx = index["by_m"].get(mode, empty)
+    else:
+        parts = [
+            ids for (m, c, d), ids in index["by_mcd"].items()
+            if (mode is None or m == mode) and (city is None or c == city) and (district is None or d == district)
+        ]
+        idx = np.sort(np.concatenate(parts)) if parts else empty
+    
+    if rooms_need is not None:
+        have = index["rooms"][idx]
+        mask = have >= 0
+        if rooms_plus:
+            mask &= have >= rooms_need
+        elif rooms_int is not None:
+            mask &= np.trunc(have) == rooms_int
+        idx = idx[mask]
+    
+    if check_price:
+        p = index["price"][idx]
+        mask = np.ones(len(idx), dtype=bool)
+        if price_lo is not None:
+            mask &= p >= price_lo
+        if price_hi is not None:
+            mask &= p <= price_hi
+        # Строки без цены (или с нечитаемой ценой) не отсеиваем
+        idx = idx[mask | (p == 0)]
+    
+    filtered = idx.tolist()
+    if len(index["memo"]) >= _FILTER_MEMO_MAX:
+        index["memo"].clear()
+    index["memo"][key] = tuple(filtered)
     logger.info(f"✅ Filtered {len(filtered)}/{len(rows)} rows")
     return filtered
 
 # ------ Safe media sending ------
-async def send_media_safe(chat_id: int, photos: List[str], text: str, retry_count: int = Config.MEDIA_RETRY_COUNT) -> bool:
+# URL фото -> file_id из ответа Telegram: повторная отправка не заставляет Telegram качать фото с Drive
+_PHOTO_FILE_IDS: LRUCache = LRUCache(maxsize=Config.PHOTO_FILE_ID_CACHE)
+# Ошибки Telegram, по которым виноват именно file_id (а не сеть, подпись и т.п.)
+_FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "FILE_REFERENCE")
+
+async def send_media_safe(chat_id: int, photos: List[str], text: str, retry_count: int = Config.MEDIA_RETRY_COUNT,
+                          reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+    """Альбом с подписью; одно фото уходит через send_photo вместе с reply_markup"""
     if not photos:
         return False
     
     for attempt in range(retry_count):
+        cached = [p for p in photos if p in _PHOTO_FILE_IDS]
         try:
-            media = [InputMediaPhoto(media=photos[0], caption=text)]
+            if len(photos) == 1:
+                await _RATE_LIMITER.acquire()
+                sent = [await bot.send_photo(chat_id, _PHOTO_FILE_IDS.get(photos[0], photos[0]), caption=text, reply_markup=reply_markup)]
+                if sent[0].photo:
+                    _PHOTO_FILE_IDS[photos[0]] = sent[0].photo[-1].file_id
+                return True
+            
+            media = [InputMediaPhoto(media=_PHOTO_FILE_IDS.get(photos[0], photos[0]), caption=text)]
             for p in photos[1:]:
-                media.append(InputMediaPhoto(media=p))
+                media.append(InputMediaPhoto(media=_PHOTO_FILE_IDS.get(p, p)))
             
-            await bot.send_media_group(chat_id, media)
+            # Альбом расходует общий лимит Telegram по числу фото
+            await _RATE_LIMITER.acquire(min(len(media), _RATE_LIMITER.max_rate))
+            sent = await bot.send_media_group(chat_id, media)
+            for p, m in zip(photos, sent or ()):
+                if m.photo:
+                    _PHOTO_FILE_IDS[p] = m.photo[-1].file_id
             return True
             
+        except TelegramRetryAfter as e:
+            logger.warning(f"⏳ Flood limit on media, retry in {e.retry_after}s")
+            if attempt < retry_count - 1:
+                await asyncio.sleep(e.retry_after)
         except Exception as e:
             error_msg = str(e)
             logger.error(f"❌ Attempt {attempt + 1}/{retry_count} failed: {error_msg[:100]}")
             
+            if cached and any(err in error_msg for err in _FILE_ID_ERRORS):
+                # Устаревший file_id — забываем и пробуем снова с исходными ссылками
+                for p in cached:
+                    _PHOTO_FILE_IDS.pop(p, None)
+                continue
+            
             if any(err in error_msg for err in ["WEBPAGE_CURL_FAILED", "WEBPAGE_MEDIA_EMPTY", "FILE_REFERENCE"]):
                 logger.warning(f"🚫 Non-recoverable error, skipping media")
                 return False
@@ -843,54 +1410,86 @@ async def send_media_safe(chat_id: int, photos: List[str], text: str, retry_coun
     
     return False
 
+async def send_chat_action_safe(chat_id: int, action: str):
+    try:
+        await bot.send_chat_action(chat_id, action)
+    except Exception:
+        pass
+
+# ------ Ad keyboards ------
+# Шаблоны (текст, callback_data) для карточки: обычная и уже в избранном
+_AD_KB_TEMPLATES = {
+    False: (
+        (("❤️ Нравится", "like:{}"), ("👎 Дизлайк", "dislike:{}")),
+        (("⭐ В избранное", "fav_add:{}"),),
+    ),
+    True: (
+        (("❤️ Нравится", "like:{}"), ("👎 Дизлайк", "dislike:{}")),
+        (("⭐ Удалить", "fav_del:{}"),),
+    ),
+}
+
+@lru_cache(maxsize=1024)
+def ad_keyboard(index: int, in_favs: bool) -> InlineKeyboardMarkup:
+    """Клавиатура карточки без pydantic-валидации: данные шаблона заведомо корректны.
+    Зависит только от (индекс, в избранном), поэтому готовые объекты переиспользуем"""
+    return InlineKeyboardMarkup.model_construct(inline_keyboard=[
+        [InlineKeyboardButton.model_construct(text=text, callback_data=data.format(index)) for text, data in row]
+        for row in _AD_KB_TEMPLATES[in_favs]
+    ])
+
+def _markup_key(kb: Optional[InlineKeyboardMarkup]) -> tuple:
+    if kb is None:
+        return ()
+    return tuple((b.text, b.callback_data) for row in kb.inline_keyboard for b in row)
+
+async def update_card_markup(cb: types.CallbackQuery, kb: InlineKeyboardMarkup):
+    """Меняет кнопки карточки, только если они действительно другие (иначе Telegram вернёт 'message is not modified')"""
+    if cb.message is None or _markup_key(cb.message.reply_markup) == _markup_key(kb):
+        return
+    try:
+        await cb.message.edit_reply_markup(reply_markup=kb)
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to update card buttons: {e}")
+
 # ------ Show single ad ------
 async def show_single_ad(chat_id: int, uid: int):
+    lang = current_lang(uid)
     bundle = USER_RESULTS.get(uid)
     if not bundle:
-        await bot.send_message(chat_id, "Список пуст.", reply_markup=main_menu(current_lang(uid)))
+        await bot.send_message(chat_id, "Список пуст.", reply_markup=main_menu(lang))
         return
     
-    rows = bundle["rows"]
-    if not rows:
-        await bot.send_message(chat_id, "Нет объявлений.", reply_markup=main_menu(current_lang(uid)))
+    row_ids = bundle["row_ids"]
+    if not row_ids:
+        await bot.send_message(chat_id, "Нет объявлений.", reply_markup=main_menu(lang))
         return
     
     current_index = USER_CURRENT_INDEX.get(uid, 0)
     
-    if current_index >= len(rows):
+    if current_index >= len(row_ids):
         await bot.send_message(
             chat_id, 
             "🎉 Вы просмотрели все объявления!\n\nВыберите действие:",
-            reply_markup=main_menu(current_lang(uid))
+            reply_markup=main_menu(lang)
         )
         return
     
-    row = rows[current_index]
-    photos = collect_photos(row)
-    text = format_card(row, current_lang(uid))
-    text += f"\n\n📊 Объявление {current_index + 1} из {len(rows)}"
+    row = result_row(bundle, current_index)
+    photos = row_photos(row)
+    text = card_text(row, lang)
+    text += f"\n\n📊 Объявление {current_index + 1} из {len(row_ids)}"
     
-    buttons = [
-        [
-            InlineKeyboardButton(text="❤️ Нравится", callback_data=f"like:{current_index}"),
-            InlineKeyboardButton(text="👎 Дизлайк", callback_data=f"dislike:{current_index}")
-        ],
-        [
-            InlineKeyboardButton(text="⭐ В избранное", callback_data=f"fav_add:{current_index}")
-        ]
-    ]
-    
-    if any(fav.get("index") == current_index for fav in USER_FAVS.get(uid, [])):
-        buttons[1] = [InlineKeyboardButton(text="⭐ Удалить", callback_data=f"fav_del:{current_index}")]
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+    in_favs = current_index in user_favs(uid)
+    kb = ad_keyboard(current_index, in_favs)
     
     if photos:
-        success = await send_media_safe(chat_id, photos, text)
-        if success:
-            await bot.send_message(chat_id, "Выберите действие:", reply_markup=kb)
-        else:
+        # У альбома не бывает кнопок — для него отдельное сообщение; одиночное фото несёт кнопки само
+        success = await send_media_safe(chat_id, photos, text, reply_markup=kb)
+        if not success:
             await bot.send_message(chat_id, f"{text}\n\n⚠️ Фото недоступны", reply_markup=kb)
+        elif len(photos) > 1:
+            await bot.send_message(chat_id, "Выберите действие:", reply_markup=kb)
     else:
         await bot.send_message(chat_id, text, reply_markup=kb)
 
@@ -898,9 +1497,10 @@ async def show_single_ad(chat_id: int, uid: int):
 @dp.message(Command("start", "menu"))
 async def cmd_start(message: types.Message, state: FSMContext):
     uid = message.from_user.id
-    if uid not in USER_LANG:
+    st = USERS[uid]
+    if st.lang is None:
         code = (message.from_user.language_code or "").strip()
-        USER_LANG[uid] = LANG_MAP.get(code, "ru")
+        st.lang = LANG_MAP.get(code, "ru")
     lang = current_lang(uid)
     await state.clear()
     
@@ -921,7 +1521,7 @@ async def cmd_health(message: types.Message):
     await message.answer(
         f"✅ Bot OK\n"
         f"Sheets enabled: {Config.SHEETS_ENABLED}\n"
-        f"Cached rows: {len(_cached_rows)}\n"
+        f"Cached rows: {len(cached_rows())}\n"
         f"Cache age: {int(monotonic() - _cache_ts)}s\n"
         f"DB: {Config.DB_PATH}"
     )
@@ -966,7 +1566,7 @@ async def cb_stats(cb: types.CallbackQuery):
         await cb.answer("Недостаточно прав")
         return
     
-    days = int(cb.data.split(":")[1])
+    days = int(cb.data.partition(":")[2])
     
     if days == 1:
         period_name = "сегодня"
@@ -1010,7 +1610,7 @@ async def cb_stats(cb: types.CallbackQuery):
         msg += "\n"
     
     msg += f"💾 <b>Система:</b>\n"
-    msg += f"  • Кэш: {len(_cached_rows)} объявлений\n"
+    msg += f"  • Кэш: {len(cached_rows())} объявлений\n"
     msg += f"  • БД: {Config.DB_PATH}\n"
     
     msg += f"\n⏰ Обновлено: {datetime.utcnow().strftime('%H:%M:%S')}"
@@ -1033,7 +1633,7 @@ async def cb_export(cb: types.CallbackQuery):
         await cb.answer("Недостаточно прав")
         return
     
-    days = int(cb.data.split(":")[1])
+    days = int(cb.data.partition(":")[2])
     await cb.answer("Создаю экспорт...")
     
     try:
@@ -1058,22 +1658,14 @@ async def cb_export(cb: types.CallbackQuery):
         await cb.message.answer(f"❌ Ошибка экспорта: {e}")
 
 # ------ Back button handler ------
-@dp.message(F.text.in_([T["btn_back"]["ru"], T["btn_back"]["en"], T["btn_back"]["ka"]]))
+@dp.message(F.text.in_(button_texts("btn_back")))
 async def handle_back(message: types.Message, state: FSMContext):
     current_state = await state.get_state()
     lang = current_lang(message.from_user.id)
     
     if current_state == Wizard.city.state:
         await state.set_state(Wizard.mode)
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text=T["btn_rent"][lang])],
-                [KeyboardButton(text=T["btn_sale"][lang])],
-                [KeyboardButton(text=T["btn_daily"][lang])],
-                [KeyboardButton(text=T["btn_back"][lang])]
-            ],
-            resize_keyboard=True
-        )
+        kb = _MODE_KB[lang]
         await message.answer("⬅️ Выберите режим:", reply_markup=kb)
         
     elif current_state == Wizard.district.state:
@@ -1082,18 +1674,7 @@ async def handle_back(message: types.Message, state: FSMContext):
         await state.set_state(Wizard.city)
         
         rows = await rows_async()
-        filtered_rows = [r for r in rows if norm_mode(r.get("mode")) == mode]
-        city_counter = Counter([str(r.get("city","")).strip() for r in filtered_rows if r.get("city")])
-        
-        buttons = []
-        for city, count in sorted(city_counter.items(), key=lambda x: (-x[1], x[0].lower())):
-            icon = CITY_ICONS.get(norm(city), "🏠")
-            label = f"{icon} {city} ({count})"
-            buttons.append([KeyboardButton(text=label)])
-        buttons.append([KeyboardButton(text=T["btn_skip"][lang])])
-        buttons.append([KeyboardButton(text=T["btn_back"][lang])])
-        
-        kb = ReplyKeyboardMarkup(keyboard=buttons[:42], resize_keyboard=True)
+        kb = city_keyboard(rows, mode, lang)
         await message.answer("⬅️ Выберите город:", reply_markup=kb)
         
     elif current_state == Wizard.rooms.state:
@@ -1104,14 +1685,7 @@ async def handle_back(message: types.Message, state: FSMContext):
             await state.set_state(Wizard.district)
             mode = data.get("mode", "")
             rows = await rows_async()
-            filtered_rows = [r for r in rows if norm_mode(r.get("mode")) == mode and norm(r.get("city")) == norm(city)]
-            district_counter = Counter([str(r.get("district","")).strip() for r in filtered_rows if r.get("district")])
-            
-            buttons = [[KeyboardButton(text=f"{d} ({c})")] for d,c in sorted(district_counter.items(), key=lambda x:(-x[1], x[0].lower()))]
-            buttons.append([KeyboardButton(text=T["btn_skip"][lang])])
-            buttons.append([KeyboardButton(text=T["btn_back"][lang])])
-            
-            kb = ReplyKeyboardMarkup(keyboard=buttons[:42], resize_keyboard=True)
+            kb = district_keyboard(rows, mode, city, lang)
             await message.answer("⬅️ Выберите район:", reply_markup=kb)
         else:
             await state.set_state(Wizard.city)
@@ -1119,38 +1693,17 @@ async def handle_back(message: types.Message, state: FSMContext):
     
     elif current_state == Wizard.price_method.state:
         await state.set_state(Wizard.rooms)
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="1"), KeyboardButton(text="2"), KeyboardButton(text="3")],
-                [KeyboardButton(text="4"), KeyboardButton(text="5+")],
-                [KeyboardButton(text=T["btn_skip"][lang]), KeyboardButton(text=T["btn_back"][lang])]
-            ],
-            resize_keyboard=True
-        )
+        kb = _ROOMS_KB[lang]
         await message.answer("⬅️ Выберите количество комнат:", reply_markup=kb)
     
     elif current_state == Wizard.price.state:
         await state.set_state(Wizard.price_method)
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text=T["btn_standard_ranges"][lang])],
-                [KeyboardButton(text=T["btn_custom_price"][lang])],
-                [KeyboardButton(text=T["btn_back"][lang])]
-            ],
-            resize_keyboard=True
-        )
+        kb = _PRICE_METHOD_KB[lang]
         await message.answer("⬅️ Как хотите указать цену?", reply_markup=kb)
     
     elif current_state == Wizard.price_min.state:
         await state.set_state(Wizard.price_method)
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text=T["btn_standard_ranges"][lang])],
-                [KeyboardButton(text=T["btn_custom_price"][lang])],
-                [KeyboardButton(text=T["btn_back"][lang])]
-            ],
-            resize_keyboard=True
-        )
+        kb = _PRICE_METHOD_KB[lang]
         await message.answer("⬅️ Как хотите указать цену?", reply_markup=kb)
     
     elif current_state == Wizard.price_max.state:
@@ -1162,7 +1715,7 @@ async def handle_back(message: types.Message, state: FSMContext):
         await message.answer("⬅️ Главное меню", reply_markup=main_menu(lang))
 
 # ------ Search flow ------
-@dp.message(F.text.in_([T["btn_search"]["ru"], T["btn_search"]["en"], T["btn_search"]["ka"]]))
+@dp.message(F.text.in_(button_texts("btn_search")))
 @dp.message(Command("search"))
 async def start_search(message: types.Message, state: FSMContext):
     await state.clear()
@@ -1171,15 +1724,7 @@ async def start_search(message: types.Message, state: FSMContext):
     
     db.log_action(message.from_user.id, "search_start")
     
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=T["btn_rent"][lang])],
-            [KeyboardButton(text=T["btn_sale"][lang])],
-            [KeyboardButton(text=T["btn_daily"][lang])],
-            [KeyboardButton(text=T["btn_back"][lang])]
-        ],
-        resize_keyboard=True
-    )
+    kb = _MODE_KB[lang]
     await message.answer("Выберите режим:", reply_markup=kb)
 
 @dp.message(Wizard.mode)
@@ -1193,24 +1738,7 @@ async def pick_city_mode(message: types.Message, state: FSMContext):
     await state.update_data(mode=mode)
 
     rows = await rows_async()
-    filtered_rows = [r for r in rows if norm_mode(r.get("mode")) == mode]
-    
-    city_counter = Counter([str(r.get("city","")).strip() for r in filtered_rows if r.get("city")])
-    
-    buttons = []
-    for city, count in sorted(city_counter.items(), key=lambda x: (-x[1], x[0].lower())):
-        icon = CITY_ICONS.get(norm(city), "🏠")
-        label = f"{icon} {city} ({count})"
-        buttons.append([KeyboardButton(text=label)])
-    
-    if not buttons:
-        buttons = [[KeyboardButton(text=T["btn_skip"][lang])]]
-    else:
-        buttons.append([KeyboardButton(text=T["btn_skip"][lang])])
-    
-    buttons.append([KeyboardButton(text=T["btn_back"][lang])])
-    
-    kb = ReplyKeyboardMarkup(keyboard=buttons[:42], resize_keyboard=True)
+    kb = city_keyboard(rows, mode, lang)
     await state.set_state(Wizard.city)
     await message.answer("Выберите город:", reply_markup=kb)
 
@@ -1219,18 +1747,11 @@ async def pick_district(message: types.Message, state: FSMContext):
     lang = current_lang(message.from_user.id)
     city_text = message.text.strip()
     
-    if city_text.lower() in {t(lang, "btn_skip").lower(), "пропустить", "skip"}:
+    if city_text.lower() in _SKIP_WORDS:
         await state.update_data(city="")
         await state.update_data(district="")
         await state.set_state(Wizard.rooms)
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="1"), KeyboardButton(text="2"), KeyboardButton(text="3")],
-                [KeyboardButton(text="4"), KeyboardButton(text="5+")],
-                [KeyboardButton(text=T["btn_skip"][lang]), KeyboardButton(text=T["btn_back"][lang])]
-            ],
-            resize_keyboard=True
-        )
+        kb = _ROOMS_KB[lang]
         await message.answer("Выберите количество комнат:", reply_markup=kb)
         return
 
@@ -1241,29 +1762,16 @@ async def pick_district(message: types.Message, state: FSMContext):
     mode = data.get("mode", "")
     
     rows = await rows_async()
-    filtered_rows = [r for r in rows if norm_mode(r.get("mode")) == mode and norm(r.get("city")) == norm(city)]
-    
-    district_counter = Counter([str(r.get("district","")).strip() for r in filtered_rows if r.get("district")])
+    district_counter = district_counts(rows, mode, city)
     
     if not district_counter:
         await state.update_data(district="")
         await state.set_state(Wizard.rooms)
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="1"), KeyboardButton(text="2"), KeyboardButton(text="3")],
-                [KeyboardButton(text="4"), KeyboardButton(text="5+")],
-                [KeyboardButton(text=T["btn_skip"][lang]), KeyboardButton(text=T["btn_back"][lang])]
-            ],
-            resize_keyboard=True
-        )
+        kb = _ROOMS_KB[lang]
         await message.answer("Выберите количество комнат:", reply_markup=kb)
         return
 
-    buttons = [[KeyboardButton(text=f"{d} ({c})")] for d,c in sorted(district_counter.items(), key=lambda x:(-x[1], x[0].lower()))]
-    buttons.append([KeyboardButton(text=T["btn_skip"][lang])])
-    buttons.append([KeyboardButton(text=T["btn_back"][lang])])
-    
-    kb = ReplyKeyboardMarkup(keyboard=buttons[:42], resize_keyboard=True)
+    kb = district_keyboard(rows, mode, city, lang)
     await state.set_state(Wizard.district)
     await message.answer("Выберите район:", reply_markup=kb)
 
@@ -1272,21 +1780,14 @@ async def pick_rooms_or_price(message: types.Message, state: FSMContext):
     lang = current_lang(message.from_user.id)
     text = message.text.strip()
     
-    if text.lower() in {t(lang, "btn_skip").lower(), "пропустить", "skip"}:
+    if text.lower() in _SKIP_WORDS:
         await state.update_data(district="")
     else:
         district = clean_button_text(text)
         await state.update_data(district=district)
 
     await state.set_state(Wizard.rooms)
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="1"), KeyboardButton(text="2"), KeyboardButton(text="3")],
-            [KeyboardButton(text="4"), KeyboardButton(text="5+")],
-            [KeyboardButton(text=T["btn_skip"][lang]), KeyboardButton(text=T["btn_back"][lang])]
-        ],
-        resize_keyboard=True
-    )
+    kb = _ROOMS_KB[lang]
     await message.answer("Выберите количество комнат:", reply_markup=kb)
 
 @dp.message(Wizard.rooms)
@@ -1294,7 +1795,7 @@ async def pick_price_method(message: types.Message, state: FSMContext):
     lang = current_lang(message.from_user.id)
     text = message.text.strip()
     
-    if text.lower() in {t(lang, "btn_skip").lower(), "пропустить", "skip"}:
+    if text.lower() in _SKIP_WORDS:
         await state.update_data(rooms="")
     else:
         val = text.strip().lower()
@@ -1303,35 +1804,23 @@ async def pick_price_method(message: types.Message, state: FSMContext):
         await state.update_data(rooms=val)
 
     await state.set_state(Wizard.price_method)
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=T["btn_standard_ranges"][lang])],
-            [KeyboardButton(text=T["btn_custom_price"][lang])],
-            [KeyboardButton(text=T["btn_back"][lang])]
-        ],
-        resize_keyboard=True
-    )
+    kb = _PRICE_METHOD_KB[lang]
     await message.answer("Как вы хотите указать цену?", reply_markup=kb)
 
 @dp.message(Wizard.price_method)
 async def handle_price_method(message: types.Message, state: FSMContext):
     lang = current_lang(message.from_user.id)
+    L = LOCALES[lang]
     text = message.text.strip()
     
-    if text == T["btn_standard_ranges"][lang]:
+    if text == L.btn_standard_ranges:
         data = await state.get_data()
         mode = data.get("mode","sale")
-        ranges = PRICE_RANGES.get(mode, PRICE_RANGES["sale"])
-        
-        buttons = [[KeyboardButton(text=p)] for p in ranges]
-        buttons.append([KeyboardButton(text=T["btn_skip"][lang])])
-        buttons.append([KeyboardButton(text=T["btn_back"][lang])])
-        
-        kb = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+        kb = _PRICE_KB.get((mode, lang)) or _PRICE_KB[("sale", lang)]
         await state.set_state(Wizard.price)
         await message.answer("Выберите ценовой диапазон:", reply_markup=kb)
     
-    elif text == T["btn_custom_price"][lang]:
+    elif text == L.btn_custom_price:
         await state.set_state(Wizard.price_min)
         await message.answer(
             "💰 <b>Укажите свой ценовой диапазон</b>\n\n"
@@ -1344,7 +1833,7 @@ async def handle_price_min(message: types.Message, state: FSMContext):
     text = message.text.strip()
     
     try:
-        price_str = re.sub(r"[^\d.]", "", text)
+        price_str = _DIGITS_DOT_RE.sub("", text)
         min_price = float(price_str)
         
         if min_price < 0:
@@ -1376,7 +1865,7 @@ async def handle_price_max(message: types.Message, state: FSMContext):
         price_range = f"от {min_price}"
     else:
         try:
-            price_str = re.sub(r"[^\d.]", "", text)
+            price_str = _DIGITS_DOT_RE.sub("", text)
             max_price = float(price_str)
             
             if max_price < 0:
@@ -1408,11 +1897,11 @@ async def handle_price_max(message: types.Message, state: FSMContext):
     }
     
     all_rows = await rows_async()
-    rows = _filter_rows(all_rows, query)
+    rows = _filter_indices(all_rows, query)
     
     db.log_search(message.from_user.id, query, len(rows))
     
-    USER_RESULTS[message.from_user.id] = {"query": query, "rows": rows, "page": 0}
+    USER_RESULTS[message.from_user.id] = make_results(query, all_rows, rows)
     USER_CURRENT_INDEX[message.from_user.id] = 0
     
     if not rows:
@@ -1430,7 +1919,7 @@ async def show_results_handler(message: types.Message, state: FSMContext):
     lang = current_lang(message.from_user.id)
     text = message.text.strip()
     
-    if text.lower() in {t(lang, "btn_skip").lower(), "пропустить", "skip"}:
+    if text.lower() in _SKIP_WORDS:
         price = ""
     else:
         price = text
@@ -1447,11 +1936,11 @@ async def show_results_handler(message: types.Message, state: FSMContext):
     }
 
     all_rows = await rows_async()
-    rows = _filter_rows(all_rows, query)
+    rows = _filter_indices(all_rows, query)
     
     db.log_search(message.from_user.id, query, len(rows))
     
-    USER_RESULTS[message.from_user.id] = {"query": query, "rows": rows, "page": 0}
+    USER_RESULTS[message.from_user.id] = make_results(query, all_rows, rows)
     USER_CURRENT_INDEX[message.from_user.id] = 0
     
     if not rows:
@@ -1468,19 +1957,19 @@ async def show_results_handler(message: types.Message, state: FSMContext):
 @dp.callback_query(F.data.startswith("like:"))
 async def cb_like(cb: types.CallbackQuery):
     uid = cb.from_user.id
-    index = int(cb.data.split(":")[1])
+    index = int(cb.data.partition(":")[2])
     
     bundle = USER_RESULTS.get(uid)
-    if not bundle or index >= len(bundle["rows"]):
+    if not bundle or index >= len(bundle["row_ids"]):
         await cb.answer("Ошибка")
         return
     
-    row = bundle["rows"][index]
+    row = result_row(bundle, index)
     
     USER_LEAD_DATA[uid] = {
         "ad_index": index,
         "ad_data": row,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": now_iso()
     }
     USER_LEAD_STATE[uid] = "awaiting_name"
     
@@ -1508,64 +1997,49 @@ async def cb_like(cb: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("dislike:"))
 async def cb_dislike(cb: types.CallbackQuery):
     uid = cb.from_user.id
-    index = int(cb.data.split(":")[1])
+    index = int(cb.data.partition(":")[2])
     
     USER_CURRENT_INDEX[uid] = index + 1
     
     db.log_action(uid, "dislike")
     
-    await cb.answer("Понятно 👎")
-    await show_single_ad(cb.message.chat.id, uid)
+    # Ответ на callback не виден в чате — отправляем параллельно со следующей карточкой
+    await asyncio.gather(
+        bot.answer_callback_query(cb.id, "Понятно 👎"),
+        show_single_ad(cb.message.chat.id, uid),
+    )
 
 @dp.callback_query(F.data.startswith("fav_add:"))
 async def cb_fav_add(cb: types.CallbackQuery):
     uid = cb.from_user.id
-    index = int(cb.data.split(":")[1])
+    index = int(cb.data.partition(":")[2])
     
     bundle = USER_RESULTS.get(uid)
-    if not bundle or index >= len(bundle["rows"]):
+    if not bundle or index >= len(bundle["row_ids"]):
         await cb.answer("Ошибка")
         return
     
-    row = bundle["rows"][index]
+    row = result_row(bundle, index)
     
-    if not any(fav.get("index") == index for fav in USER_FAVS[uid]):
-        USER_FAVS[uid].append({"index": index, "data": row})
+    favs = USERS[uid].favs
+    if index not in favs:
+        favs[index] = row
         
         db.log_favorite(uid, "add", row)
         db.log_action(uid, "favorite_add")
         
         await cb.answer("⭐ Добавлено!")
         
-        buttons = [
-            [
-                InlineKeyboardButton(text="❤️ Нравится", callback_data=f"like:{index}"),
-                InlineKeyboardButton(text="👎 Дизлайк", callback_data=f"dislike:{index}")
-            ],
-            [
-                InlineKeyboardButton(text="⭐ Удалить", callback_data=f"fav_del:{index}")
-            ]
-        ]
-        kb = InlineKeyboardMarkup(inline_keyboard=buttons)
-        try:
-            await cb.message.edit_reply_markup(reply_markup=kb)
-        except Exception:
-            pass
+        await update_card_markup(cb, ad_keyboard(index, True))
     else:
         await cb.answer("Уже в избранном!")
 
 @dp.callback_query(F.data.startswith("fav_del:"))
 async def cb_fav_del(cb: types.CallbackQuery):
     uid = cb.from_user.id
-    index = int(cb.data.split(":")[1])
-    
-    row = None
-    for fav in USER_FAVS[uid]:
-        if fav.get("index") == index:
-            row = fav.get("data")
-            break
+    index = int(cb.data.partition(":")[2])
     
-    USER_FAVS[uid] = [fav for fav in USER_FAVS[uid] if fav.get("index") != index]
+    row = user_favs(uid).pop(index, None)
     
     if row:
         db.log_favorite(uid, "remove", row)
@@ -1573,32 +2047,22 @@ async def cb_fav_del(cb: types.CallbackQuery):
     
     await cb.answer("Удалено")
     
-    buttons = [
-        [
-            InlineKeyboardButton(text="❤️ Нравится", callback_data=f"like:{index}"),
-            InlineKeyboardButton(text="👎 Дизлайк", callback_data=f"dislike:{index}")
-        ],
-        [
-            InlineKeyboardButton(text="⭐ В избранное", callback_data=f"fav_add:{index}")
-        ]
-    ]
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
-    try:
-        await cb.message.edit_reply_markup(reply_markup=kb)
-    except Exception:
-        pass
+    await update_card_markup(cb, ad_keyboard(index, False))
 
 # ------ Lead form ------
 async def handle_lead_form(message: types.Message):
     uid = message.from_user.id
     
-    if uid not in USER_LEAD_STATE:
+    state = USER_LEAD_STATE.get(uid)
+    lead = USER_LEAD_DATA.get(uid)
+    if state is None or lead is None:
+        USER_LEAD_STATE.pop(uid, None)
         return
     
-    state = USER_LEAD_STATE[uid]
-    
     if state == "awaiting_name":
-        USER_LEAD_DATA[uid]["name"] = message.text.strip()
+        lead["name"] = message.text.strip()
+        # Перезаписываем оба ключа, чтобы у состояния и данных заявки был общий TTL
+        USER_LEAD_DATA[uid] = lead
         USER_LEAD_STATE[uid] = "awaiting_phone"
         
         await message.answer(
@@ -1607,12 +2071,13 @@ async def handle_lead_form(message: types.Message):
         )
         
     elif state == "awaiting_phone":
-        USER_LEAD_DATA[uid]["phone"] = message.text.strip()
+        lead["phone"] = message.text.strip()
         
-        await send_lead_to_channel(uid)
+        # Доставка заявки (ретраи, запасной канал) не задерживает ответ пользователю
+        await _LEAD_Q.put((uid, lead))
         
-        del USER_LEAD_STATE[uid]
-        lead_data = USER_LEAD_DATA.pop(uid)
+        USER_LEAD_STATE.pop(uid, None)
+        USER_LEAD_DATA.pop(uid, None)
         
         await message.answer(
             "✅ <b>Спасибо!</b> Ваша заявка принята.\n\n"
@@ -1620,60 +2085,92 @@ async def handle_lead_form(message: types.Message):
             reply_markup=main_menu(current_lang(uid))
         )
         
-        current_index = lead_data.get("ad_index", 0)
+        current_index = lead.get("ad_index", 0)
         USER_CURRENT_INDEX[uid] = current_index + 1
         
-        await asyncio.sleep(1)
-        await show_single_ad(message.chat.id, uid)
+        # Индикатор не ждём отдельно: он уходит параллельно с загрузкой следующей карточки
+        await asyncio.gather(
+            send_chat_action_safe(message.chat.id, "typing"),
+            show_single_ad(message.chat.id, uid),
+        )
 
-async def send_lead_to_channel(uid: int):
-    if uid not in USER_LEAD_DATA:
-        return
-    
-    lead = USER_LEAD_DATA[uid]
+# Если канал заявок недоступен, после нескольких неудач подряд шлём заявки админу
+_channel_breaker = {"fails": 0, "open_until": 0.0}
+
+LEAD_TPL = (
+    "🔥 <b>НОВАЯ ЗАЯВКА</b>\n\n"
+    "👤 <b>Имя:</b> {lead[name]}\n"
+    "📱 <b>Телефон:</b> {lead[phone]}\n"
+    "🆔 <b>User ID:</b> {uid}\n\n"
+    "<b>Интересующее объявление:</b>\n"
+    "🏠 {ad[title_ru]}\n"
+    "📍 {ad[city]} {ad[district]}\n"
+    "💰 {ad[price]}\n"
+    "🛏 {ad[rooms]} комнат\n"
+    "☎️ Телефон владельца: {ad[phone]}\n\n"
+    "⏰ {lead[timestamp]}"
+)
+# Значения для отсутствующих полей — как раньше в .get(..., default)
+_LEAD_DEFAULTS = {"name": "Не указано", "phone": "Не указано", "timestamp": ""}
+_LEAD_AD_DEFAULTS = {"title_ru": "Без названия", "city": "", "district": "", "price": "Не указана", "rooms": "", "phone": "Не указан"}
+_LEAD_Q: "asyncio.Queue[Tuple[int, Dict[str, Any]]]" = asyncio.Queue()
+
+async def lead_worker():
+    while True:
+        uid, lead = await _LEAD_Q.get()
+        try:
+            await send_lead_to_channel(uid, lead)
+        except Exception as e:
+            logger.exception(f"❌ Lead delivery for user {uid} failed: {e}")
+        finally:
+            _LEAD_Q.task_done()
+
+async def send_lead_to_channel(uid: int, lead: Dict[str, Any]):
     ad = lead.get("ad_data", {})
     
     db.log_lead(uid, lead.get('name', ''), lead.get('phone', ''), ad)
     db.log_action(uid, "lead_submitted")
     
-    text = (
-        "🔥 <b>НОВАЯ ЗАЯВКА</b>\n\n"
-        f"👤 <b>Имя:</b> {lead.get('name', 'Не указано')}\n"
-        f"📱 <b>Телефон:</b> {lead.get('phone', 'Не указано')}\n"
-        f"🆔 <b>User ID:</b> {uid}\n\n"
-        f"<b>Интересующее объявление:</b>\n"
-        f"🏠 {ad.get('title_ru', 'Без названия')}\n"
-        f"📍 {ad.get('city', '')} {ad.get('district', '')}\n"
-        f"💰 {ad.get('price', 'Не указана')}\n"
-        f"🛏 {ad.get('rooms', '')} комнат\n"
-        f"☎️ Телефон владельца: {ad.get('phone', 'Не указан')}\n\n"
-        f"⏰ {lead.get('timestamp', '')}"
-    )
+    text = LEAD_TPL.format(uid=uid, lead=ChainMap(lead, _LEAD_DEFAULTS), ad=ChainMap(ad, _LEAD_AD_DEFAULTS))
+    
+    if monotonic() < _channel_breaker["open_until"]:
+        await send_lead_to_admin(uid, text)
+        return
     
     for attempt in range(3):
         try:
-            await bot.send_message(Config.FEEDBACK_CHAT_ID, text)
+            async with _RATE_LIMITER:
+                await bot.send_message(Config.FEEDBACK_CHAT_ID, text)
+            _channel_breaker["fails"] = 0
             logger.info(f"✅ Lead sent to channel for user {uid}")
             return
         except Exception as e:
             logger.error(f"❌ Attempt {attempt + 1}/3 failed to send lead: {e}")
             if attempt < 2:
-                await asyncio.sleep(2)
+                await asyncio.sleep(0.5 * 2 ** attempt)
+    
+    _channel_breaker["fails"] += 1
+    if _channel_breaker["fails"] >= Config.LEAD_BREAKER_FAILS:
+        _channel_breaker["open_until"] = monotonic() + Config.LEAD_BREAKER_COOLDOWN_SEC
+        logger.warning(f"🚫 Feedback channel disabled for {Config.LEAD_BREAKER_COOLDOWN_SEC}s after {_channel_breaker['fails']} failed leads")
+    await send_lead_to_admin(uid, text)
+
+async def send_lead_to_admin(uid: int, text: str):
+    if not Config.ADMIN_CHAT_ID:
+        return
+    await queue_message(Config.ADMIN_CHAT_ID, text)
+    logger.info(f"📨 Lead for user {uid} queued to admin instead of channel")
 
 # ------ Other handlers ------
-@dp.message(F.text.in_([T["btn_language"]["ru"], T["btn_language"]["en"], T["btn_language"]["ka"]]))
 async def choose_language(message: types.Message, state: FSMContext):
     await state.clear()
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text=l.upper(), callback_data=f"lang:{l}")] for l in LANGS]
-    )
-    await message.answer("Выберите язык / Choose language / ენა", reply_markup=kb)
+    await message.answer("Выберите язык / Choose language / ენა", reply_markup=_LANG_KB)
 
 @dp.callback_query(F.data.startswith("lang:"))
 async def cb_set_lang(cb: types.CallbackQuery):
     uid = cb.from_user.id
-    lang = cb.data.split(":")[1]
-    USER_LANG[uid] = lang
+    lang = cb.data.partition(":")[2]
+    USERS[uid].lang = lang
     await cb.answer(f"Язык установлен: {lang.upper()}")
     try:
         await cb.message.delete()
@@ -1681,7 +2178,6 @@ async def cb_set_lang(cb: types.CallbackQuery):
         pass
     await cb.message.answer("Меню:", reply_markup=main_menu(lang))
 
-@dp.message(F.text.in_([T["btn_fast"]["ru"], T["btn_fast"]["en"], T["btn_fast"]["ka"]]))
 async def quick_pick_entry(msg: types.Message, state: FSMContext):
     await state.clear()
     rows = await rows_async()
@@ -1691,30 +2187,28 @@ async def quick_pick_entry(msg: types.Message, state: FSMContext):
     
     db.log_action(msg.from_user.id, "quick_pick")
     
-    sorted_rows = sorted(rows, key=lambda x: str(x.get("published", "")), reverse=True)[:20]
-    USER_RESULTS[msg.from_user.id] = {"query": {}, "rows": sorted_rows, "page": 0}
+    top_ids = latest_ids(rows)
+    USER_RESULTS[msg.from_user.id] = make_results({}, rows, top_ids)
     USER_CURRENT_INDEX[msg.from_user.id] = 0
     
     await msg.answer("🟢 <b>Быстрый подбор</b>\n\nПоказываю лучшие новые объявления:")
     await show_single_ad(msg.chat.id, msg.from_user.id)
 
-@dp.message(F.text.in_([T["btn_favs"]["ru"], T["btn_favs"]["en"], T["btn_favs"]["ka"]]))
 async def show_favorites(message: types.Message, state: FSMContext):
     await state.clear()
     uid = message.from_user.id
-    favs = USER_FAVS.get(uid, [])
+    favs = user_favs(uid)
     
     db.log_action(uid, "view_favorites")
     
     if not favs:
         await message.answer("У вас пока нет избранных объявлений.")
     else:
-        USER_RESULTS[uid] = {"query": {}, "rows": [f["data"] for f in favs], "page": 0}
+        USER_RESULTS[uid] = make_results({}, list(favs.values()), list(range(len(favs))))
         USER_CURRENT_INDEX[uid] = 0
         await message.answer(f"У вас {len(favs)} избранных объявлений:")
         await show_single_ad(message.chat.id, uid)
 
-@dp.message(F.text.in_([T["btn_latest"]["ru"], T["btn_latest"]["en"], T["btn_latest"]["ka"]]))
 async def show_latest(message: types.Message, state: FSMContext):
     await state.clear()
     rows = await rows_async()
@@ -1724,32 +2218,48 @@ async def show_latest(message: types.Message, state: FSMContext):
     
     db.log_action(message.from_user.id, "view_latest")
     
-    sorted_rows = sorted(rows, key=lambda x: str(x.get("published", "")), reverse=True)[:20]
-    USER_RESULTS[message.from_user.id] = {"query": {}, "rows": sorted_rows, "page": 0}
+    top_ids = latest_ids(rows)
+    USER_RESULTS[message.from_user.id] = make_results({}, rows, top_ids)
     USER_CURRENT_INDEX[message.from_user.id] = 0
     await show_single_ad(message.chat.id, message.from_user.id)
 
-@dp.message(F.text.in_([T["btn_about"]["ru"], T["btn_about"]["en"], T["btn_about"]["ka"]]))
 async def show_about(message: types.Message, state: FSMContext):
     await state.clear()
     lang = current_lang(message.from_user.id)
     await message.answer(t(lang, "about"))
 
-@dp.message(F.text.in_([T["btn_home"]["ru"], T["btn_home"]["en"], T["btn_home"]["ka"]]))
 async def show_menu(message: types.Message, state: FSMContext):
     lang = current_lang(message.from_user.id)
     await state.clear()
-    await message.answer(T["menu_title"][lang], reply_markup=main_menu(lang))
+    await message.answer(LOCALES[lang].menu_title, reply_markup=main_menu(lang))
+
+# ------ Menu buttons ------
+# Одна регистрация вместо отдельного фильтра на каждую кнопку: текст -> обработчик
+_BUTTON_ROUTES: Dict[str, Callable[[types.Message, FSMContext], Awaitable[Any]]] = {
+    T[key][lang]: handler
+    for key, handler in (
+        ("btn_language", choose_language),
+        ("btn_fast", quick_pick_entry),
+        ("btn_favs", show_favorites),
+        ("btn_latest", show_latest),
+        ("btn_about", show_about),
+        ("btn_home", show_menu),
+    )
+    for lang in LANGS
+}
+
+@dp.message(F.text.in_(_BUTTON_ROUTES))
+async def route_menu_button(message: types.Message, state: FSMContext):
+    await _BUTTON_ROUTES[message.text](message, state)
+
+# Форма заявки: фильтр отсекает всех, кто её не заполняет, ещё до вызова обработчика
+dp.message(F.text, lambda m: m.from_user is not None and m.from_user.id in USER_LEAD_STATE)(handle_lead_form)
 
 # ------ Fallback ------
 @dp.message()
 async def fallback_all(message: types.Message, state: FSMContext):
     uid = message.from_user.id
     
-    if uid in USER_LEAD_STATE:
-        await handle_lead_form(message)
-        return
-    
     text = (message.text or "").strip()
     if not text:
         await message.answer("Я получил сообщение, но оно пустое.")
@@ -1762,47 +2272,75 @@ async def fallback_all(message: types.Message, state: FSMContext):
 
 # ------ Background tasks ------
 async def auto_refresh_cache():
+    # Просыпаемся к истечению TTL; обычная (не принудительная) загрузка сверяет modifiedTime в Drive
+    floor = min(30, Config.GSHEET_REFRESH_SEC)
     while True:
         try:
-            await asyncio.sleep(Config.GSHEET_REFRESH_SEC)
-            logger.info("🔄 Auto-refresh: loading data from Google Sheets...")
-            rows = await rows_async(force=True)
-            logger.info(f"✅ Auto-refresh complete: {len(rows)} rows in cache")
+            age = monotonic() - _cache_ts
+            await asyncio.sleep(max(floor, Config.GSHEET_REFRESH_SEC - age))
+            logger.info("🔄 Auto-refresh: checking Google Sheets...")
+            await _bg_refresh()
+            logger.info(f"✅ Auto-refresh complete: {len(cached_rows())} rows in cache")
         except Exception as e:
             logger.exception(f"❌ Auto-refresh error: {e}")
             await asyncio.sleep(60)
 
 async def heartbeat():
+    """Раз в HEARTBEAT_SEC: чистка просроченных сессий, событий в БД и сборка мусора при росте памяти"""
+    gc_mark_mb = float(Config.GC_RSS_MB)
     while True:
+        await asyncio.sleep(Config.HEARTBEAT_SEC)
         try:
-            logger.info(f"💓 Heartbeat OK | Cache: {len(_cached_rows)} rows | Age: {int(monotonic() - _cache_ts)}s")
+            # TTLCache удаляет просроченное только при записи — у неактивного бота память не освобождается
+            for cache in (USER_RESULTS, USER_CURRENT_INDEX, USER_LEAD_STATE, USER_LEAD_DATA):
+                cache.expire()
+            rss_mb = psutil.Process().memory_info().rss / 2**20 if psutil is not None else 0.0
+            if Config.GC_RSS_MB and rss_mb > gc_mark_mb:
+                logger.info("🧹 RSS %.0f MB above %.0f MB, collected %d objects", rss_mb, gc_mark_mb, gc.collect())
+                # gc.collect() редко возвращает память ОС — следующая сборка только если RSS вырастет ещё на 10%
+                gc_mark_mb = rss_mb * 1.1
+            elif rss_mb < Config.GC_RSS_MB:
+                gc_mark_mb = float(Config.GC_RSS_MB)
+            logger.info(
+                "💓 Heartbeat OK | Cache: %d rows | Age: %ds | Users: %d | Sessions: %d | RSS: %.0f MB",
+                len(cached_rows()), monotonic() - _cache_ts, len(USERS), len(USER_RESULTS), rss_mb,
+            )
+            if Config.ACTIONS_RETENTION_DAYS > 0:
+                pruned = await asyncio.to_thread(db.prune_actions, Config.ACTIONS_RETENTION_DAYS)
+                if pruned:
+                    logger.info("🧹 Pruned %d old user actions", pruned)
         except Exception:
             logger.exception("❌ Heartbeat error")
-        await asyncio.sleep(600)
 
 # ------ Startup / Shutdown ------
 async def startup():
-    logger.info("🚀 LivePlace bot starting...")
+    global _refresh_task
+    logger.info("🚀 LivePlace bot starting... (event loop: %s)", type(asyncio.get_running_loop()).__module__)
     
     try:
-        await rows_async(force=True)
+        if load_snapshot():
+            # Храним ссылку: задачу не соберёт GC, и rows_async не запустит второе обновление
+            _refresh_task = asyncio.create_task(_bg_refresh())
+        else:
+            await rows_async(force=True)
     except Exception as e:
         logger.error(f"❌ Failed to load initial data: {e}")
         logger.warning("⚠️ Bot will continue with empty cache")
     
+    for _ in range(Config.SEND_WORKERS):
+        asyncio.create_task(send_worker())
+    asyncio.create_task(lead_worker())
+    
     if Config.ADMIN_CHAT_ID:
-        try:
-            await bot.send_message(
-                Config.ADMIN_CHAT_ID, 
-                f"✅ <b>LivePlace bot started</b>\n\n"
-                f"📊 Loaded: {len(_cached_rows)} ads\n"
-                f"💖 Animated likes: ENABLED\n"
-                f"🔄 Auto-refresh: every {Config.GSHEET_REFRESH_SEC}s\n"
-                f"📢 Feedback channel: {Config.FEEDBACK_CHAT_ID}\n"
-                f"💾 Database: {Config.DB_PATH}"
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify admin on startup: {e}")
+        await queue_message(
+            Config.ADMIN_CHAT_ID, 
+            f"✅ <b>LivePlace bot started</b>\n\n"
+            f"📊 Loaded: {len(cached_rows())} ads\n"
+            f"💖 Animated likes: ENABLED\n"
+            f"🔄 Auto-refresh: every {Config.GSHEET_REFRESH_SEC}s\n"
+            f"📢 Feedback channel: {Config.FEEDBACK_CHAT_ID}\n"
+            f"💾 Database: {Config.DB_PATH}"
+        )
     
     asyncio.create_task(heartbeat())
     asyncio.create_task(auto_refresh_cache())
@@ -1813,6 +2351,12 @@ async def shutdown():
     try:
         logger.info("🛑 Bot shutting down...")
         
+        # Даём воркерам дослать заявки и уведомления из очередей
+        try:
+            await asyncio.wait_for(asyncio.gather(_LEAD_Q.join(), _SEND_Q.join()), timeout=10)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Unsent on shutdown: {_LEAD_Q.qsize()} leads, {_SEND_Q.qsize()} messages")
+        
         if Config.ADMIN_CHAT_ID:
             try:
                 await bot.send_message(
@@ -1823,6 +2367,8 @@ async def shutdown():
                 pass
         
         await bot.session.close()
+        await dp.storage.close()
+        _SHEETS_POOL.shutdown(wait=False, cancel_futures=True)
         logger.info("✅ Bot shutdown complete")
     except Exception as e:
         logger.exception(f"Error during shutdown: {e}")
@@ -1832,7 +2378,12 @@ async def main():
     try:
         await startup()
         logger.info("🎯 Starting polling...")
-        await dp.start_polling(bot, skip_updates=True)
+        # Длинный long-poll и только те типы апдейтов, на которые есть хендлеры (message, callback_query)
+        await dp.start_polling(
+            bot, skip_updates=True,
+            polling_timeout=Config.POLLING_TIMEOUT,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
     except KeyboardInterrupt:
         logger.info("⌨️ Received keyboard interrupt")
     except Exception as e:
@@ -1841,8 +2392,14 @@ async def main():
         await shutdown()
 
 if __name__ == "__main__":
+    # uvloop.run сам создаёт libuv-цикл; политики цикла устарели в новых версиях Python
+    run = asyncio.run
+    if uvloop is not None and hasattr(uvloop, "run"):
+        run = uvloop.run
+    elif uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         logger.info("👋 Bot stopped by user")
     except Exception as e: